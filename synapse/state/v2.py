@@ -16,7 +16,8 @@
 import heapq
 import itertools
 import logging
-from typing import Dict, List, Optional
+from collections import deque
+from typing import Dict, FrozenSet, List, Optional, Tuple
 
 from twisted.internet import defer
 
@@ -72,6 +73,10 @@ def resolve_events_with_store(
 
     logger.debug("Computing conflicted state")
 
+    # We look up the auth event IDs of the same events many times, so we cache
+    # them for the duration of the resolution.
+    auth_event_ids_cache = {}  # type: Dict[str, Tuple[str, ...]]
+
     # We use event_map as a cache, so if its None we need to initialize it
     if event_map is None:
         event_map = {}
@@ -89,17 +94,11 @@ def resolve_events_with_store(
     # auth chains.
     auth_diff = yield _get_auth_chain_difference(state_sets, event_map, state_res_store)
 
-    full_conflicted_set = set(
-        itertools.chain(
-            itertools.chain.from_iterable(conflicted_state.values()), auth_diff
-        )
-    )
+    full_conflicted_set = set(auth_diff)
+    for event_ids in conflicted_state.values():
+        full_conflicted_set.update(event_ids)
 
-    events = yield state_res_store.get_events(
-        [eid for eid in full_conflicted_set if eid not in event_map],
-        allow_rejected=True,
-    )
-    event_map.update(events)
+    yield _prefetch_events(full_conflicted_set, event_map, state_res_store)
 
     # everything in the event map should be in the right room
     for event in event_map.values():
@@ -109,7 +108,9 @@ def resolve_events_with_store(
                 % (room_id, event.event_id, event.room_id,)
             )
 
-    full_conflicted_set = {eid for eid in full_conflicted_set if eid in event_map}
+    full_conflicted_set.difference_update(
+        [eid for eid in full_conflicted_set if eid not in event_map]
+    )
 
     logger.debug("%d full_conflicted_set entries", len(full_conflicted_set))
 
@@ -119,7 +120,13 @@ def resolve_events_with_store(
     )
 
     sorted_power_events = yield _reverse_topological_power_sort(
-        clock, room_id, power_events, event_map, state_res_store, full_conflicted_set
+        clock,
+        room_id,
+        power_events,
+        event_map,
+        state_res_store,
+        full_conflicted_set,
+        auth_event_ids_cache,
     )
 
     logger.debug("sorted %d power events", len(sorted_power_events))
@@ -133,6 +140,7 @@ def resolve_events_with_store(
         unconflicted_state,
         event_map,
         state_res_store,
+        auth_event_ids_cache,
     )
 
     logger.debug("resolved power events")
@@ -140,29 +148,34 @@ def resolve_events_with_store(
     # OK, so we've now resolved the power events. Now sort the remaining
     # events using the mainline of the resolved power level.
 
-    set_power_events = set(sorted_power_events)
-    leftover_events = [
-        ev_id for ev_id in full_conflicted_set if ev_id not in set_power_events
-    ]
+    leftover_events = list(full_conflicted_set.difference(sorted_power_events))
 
-    logger.debug("sorting %d remaining events", len(leftover_events))
+    if leftover_events:
+        logger.debug("sorting %d remaining events", len(leftover_events))
 
-    pl = resolved_state.get((EventTypes.PowerLevels, ""), None)
-    leftover_events = yield _mainline_sort(
-        clock, room_id, leftover_events, pl, event_map, state_res_store
-    )
-
-    logger.debug("resolving remaining events")
+        pl = resolved_state.get((EventTypes.PowerLevels, ""), None)
+        leftover_events = yield _mainline_sort(
+            clock,
+            room_id,
+            leftover_events,
+            pl,
+            event_map,
+            state_res_store,
+            auth_event_ids_cache,
+        )
 
-    resolved_state = yield _iterative_auth_checks(
-        clock,
-        room_id,
-        room_version,
-        leftover_events,
-        resolved_state,
-        event_map,
-        state_res_store,
-    )
+        logger.debug("resolving remaining events")
+
+        resolved_state = yield _iterative_auth_checks(
+            clock,
+            room_id,
+            room_version,
+            leftover_events,
+            resolved_state,
+            event_map,
+            state_res_store,
+            auth_event_ids_cache,
+        )
 
     logger.debug("resolved")
 
@@ -174,54 +187,72 @@ def resolve_events_with_store(
     return resolved_state
 
 
-@defer.inlineCallbacks
-def _get_power_level_for_sender(room_id, event_id, event_map, state_res_store):
+def _get_power_level_for_sender(
+    room_id, event_id, event_map, power_levels_cache, auth_event_ids_cache
+):
     """Return the power level of the sender of the given event according to
     their auth events.
 
+    The event and its auth events must already have been fetched into
+    event_map.
+
     Args:
         room_id (str)
         event_id (str)
         event_map (dict[str,FrozenEvent])
-        state_res_store (StateResolutionStore)
+        power_levels_cache (dict[str, dict[str, int]]): A map from power level
+            event ID to the levels of the senders we've already looked up in
+            it. This is updated with the result.
+        auth_event_ids_cache (dict[str, tuple[str]]): A cache of event ID to
+            auth event IDs, as used by `_get_auth_event_ids`.
 
     Returns:
-        Deferred[int]
+        int
     """
-    event = yield _get_event(room_id, event_id, event_map, state_res_store)
+    event = event_map[event_id]
 
     pl = None
-    for aid in event.auth_event_ids():
-        aev = yield _get_event(
-            room_id, aid, event_map, state_res_store, allow_none=True
-        )
-        if aev and (aev.type, aev.state_key) == (EventTypes.PowerLevels, ""):
-            pl = aev
+    create_event = None
+    for aid in _get_auth_event_ids(event, auth_event_ids_cache):
+        aev = _get_prefetched_event(room_id, aid, event_map)
+        if not aev:
+            continue
+
+        key = (aev.type, aev.state_key)
+        if key == (EventTypes.PowerLevels, ""):
+            pl = aid
             break
 
+        if key == (EventTypes.Create, "") and create_event is None:
+            create_event = aev
+
     if pl is None:
         # Couldn't find power level. Check if they're the creator of the room
-        for aid in event.auth_event_ids():
-            aev = yield _get_event(
-                room_id, aid, event_map, state_res_store, allow_none=True
-            )
-            if aev and (aev.type, aev.state_key) == (EventTypes.Create, ""):
-                if aev.content.get("creator") == event.sender:
-                    return 100
-                break
+        if create_event and create_event.content.get("creator") == event.sender:
+            return 100
         return 0
 
-    level = pl.content.get("users", {}).get(event.sender)
+    # Many of the events we sort will point at the same power level event, so
+    # we cache the levels we calculate from each one.
+    levels = power_levels_cache.setdefault(pl, {})
+    level = levels.get(event.sender)
+    if level is not None:
+        return level
+
+    pl_content = event_map[pl].content
+    level = pl_content.get("users", {}).get(event.sender)
     if level is None:
-        level = pl.content.get("users_default", 0)
+        level = pl_content.get("users_default", 0)
 
     if level is None:
-        return 0
+        level = 0
     else:
-        return int(level)
+        level = int(level)
+
+    levels[event.sender] = level
+    return level
 
 
-@defer.inlineCallbacks
 def _get_auth_chain_difference(state_sets, event_map, state_res_store):
     """Compare the auth chains of each state set and return the set of events
     that only appear in some but not all of the auth chains.
@@ -235,12 +266,10 @@ def _get_auth_chain_difference(state_sets, event_map, state_res_store):
         Deferred[set[str]]: Set of event IDs
     """
 
-    difference = yield state_res_store.get_auth_chain_difference(
+    return state_res_store.get_auth_chain_difference(
         [set(state_set.values()) for state_set in state_sets]
     )
 
-    return difference
-
 
 def _seperate(state_sets):
     """Return the unconflicted and conflicted state. This is different than in
@@ -252,22 +281,46 @@ def _seperate(state_sets):
 
     Returns:
         tuple[dict, dict]: A tuple of unconflicted and conflicted state. The
-        conflicted state dict is a map from type/state_key to set of event IDs
+        conflicted state dict is a map from type/state_key to frozenset of
+        event IDs
     """
     unconflicted_state = {}
     conflicted_state = {}
 
-    for key in set(itertools.chain.from_iterable(state_sets)):
-        event_ids = {state_set.get(key) for state_set in state_sets}
-        if len(event_ids) == 1:
-            unconflicted_state[key] = event_ids.pop()
-        else:
-            event_ids.discard(None)
-            conflicted_state[key] = event_ids
+    # Most keys are usually unconflicted, so we only create a set of event IDs
+    # for a key once we see it with differing values.
+    for state_set in state_sets:
+        for key, event_id in state_set.items():
+            if key in conflicted_state:
+                conflicted_state[key].add(event_id)
+            elif key in unconflicted_state:
+                if unconflicted_state[key] != event_id:
+                    conflicted_state[key] = {unconflicted_state.pop(key), event_id}
+            else:
+                unconflicted_state[key] = event_id
+
+    # A key is also conflicted if it is missing from any of the state sets.
+    for key in list(unconflicted_state):
+        if not all(key in state_set for state_set in state_sets):
+            conflicted_state[key] = {unconflicted_state.pop(key)}
+
+    # Many keys tend to be conflicted between the same few events (e.g. when
+    # the state sets come from similar forks), so we intern the sets of event
+    # IDs to share them between keys.
+    interned = {}  # type: Dict[FrozenSet[str], FrozenSet[str]]
+    for key, event_ids in conflicted_state.items():
+        event_ids = frozenset(event_ids)
+        conflicted_state[key] = interned.setdefault(event_ids, event_ids)
 
     return unconflicted_state, conflicted_state
 
 
+# The (type, state_key) pairs of state events that are always power events.
+_POWER_EVENT_KEYS = frozenset(
+    {(EventTypes.PowerLevels, ""), (EventTypes.JoinRules, ""), (EventTypes.Create, "")}
+)
+
+
 def _is_power_event(event):
     """Return whether or not the event is a "power event", as defined by the
     v2 state resolution algorithm
@@ -278,11 +331,7 @@ def _is_power_event(event):
     Returns:
         boolean
     """
-    if (event.type, event.state_key) in (
-        (EventTypes.PowerLevels, ""),
-        (EventTypes.JoinRules, ""),
-        (EventTypes.Create, ""),
-    ):
+    if (event.type, event.state_key) in _POWER_EVENT_KEYS:
         return True
 
     if event.type == EventTypes.Member:
@@ -292,44 +341,54 @@ def _is_power_event(event):
     return False
 
 
-@defer.inlineCallbacks
 def _add_event_and_auth_chain_to_graph(
-    graph, room_id, event_id, event_map, state_res_store, auth_diff
+    graph, event_id, event_map, auth_diff, auth_event_ids_cache
 ):
     """Helper function for _reverse_topological_power_sort that add the event
     and its auth chain (that is in the auth diff) to the graph
 
+    The event and all the events in the auth diff must already be in
+    `event_map`.
+
     Args:
         graph (dict[str, set[str]]): A map from event ID to the events auth
             event IDs
-        room_id (str): the room we are working in
         event_id (str): Event to add to the graph
         event_map (dict[str,FrozenEvent])
-        state_res_store (StateResolutionStore)
         auth_diff (set[str]): Set of event IDs that are in the auth difference.
+        auth_event_ids_cache (dict[str, tuple[str]]): A cache of event ID to
+            auth event IDs, as used by `_get_auth_event_ids`.
     """
 
-    state = [event_id]
-    while state:
-        eid = state.pop()
-        graph.setdefault(eid, set())
-
-        event = yield _get_event(room_id, eid, event_map, state_res_store)
-        for aid in event.auth_event_ids():
-            if aid in auth_diff:
-                if aid not in graph:
-                    state.append(aid)
+    queue = deque([event_id])
+    while queue:
+        eid = queue.popleft()
+        if eid in graph:
+            continue
 
-                graph.setdefault(eid, set()).add(aid)
+        edges = auth_diff.intersection(
+            _get_auth_event_ids(event_map[eid], auth_event_ids_cache)
+        )
+        graph[eid] = edges
+        queue.extend(aid for aid in edges if aid not in graph)
 
 
 @defer.inlineCallbacks
 def _reverse_topological_power_sort(
-    clock, room_id, event_ids, event_map, state_res_store, auth_diff
+    clock,
+    room_id,
+    event_ids,
+    event_map,
+    state_res_store,
+    auth_diff,
+    auth_event_ids_cache,
 ):
     """Returns a list of the event_ids sorted by reverse topological ordering,
     and then by power level and origin_server_ts
 
+    The events to sort and the events in the auth diff must already be in
+    `event_map`.
+
     Args:
         clock (Clock)
         room_id (str): the room we are working in
@@ -337,15 +396,19 @@ def _reverse_topological_power_sort(
         event_map (dict[str,FrozenEvent])
         state_res_store (StateResolutionStore)
         auth_diff (set[str]): Set of event IDs that are in the auth difference.
+        auth_event_ids_cache (dict[str, tuple[str]]): A cache of event ID to
+            auth event IDs, as used by `_get_auth_event_ids`.
 
     Returns:
         Deferred[list[str]]: The sorted list
     """
 
+    # The events we're sorting and the auth diff have all already been
+    # fetched, so we can build the graph without going to the database.
     graph = {}
     for idx, event_id in enumerate(event_ids, start=1):
-        yield _add_event_and_auth_chain_to_graph(
-            graph, room_id, event_id, event_map, state_res_store, auth_diff
+        _add_event_and_auth_chain_to_graph(
+            graph, event_id, event_map, auth_diff, auth_event_ids_cache
         )
 
         # We yield occasionally when we're working with large data sets to
@@ -353,10 +416,22 @@ def _reverse_topological_power_sort(
         if idx % _YIELD_AFTER_ITERATIONS == 0:
             yield clock.sleep(0)
 
+    # Fetch all the auth events we need to look up the power levels in one go.
+    yield _prefetch_events(
+        {
+            aid
+            for event_id in graph
+            for aid in _get_auth_event_ids(event_map[event_id], auth_event_ids_cache)
+        },
+        event_map,
+        state_res_store,
+    )
+
     event_to_pl = {}
+    power_levels_cache = {}
     for idx, event_id in enumerate(graph, start=1):
-        pl = yield _get_power_level_for_sender(
-            room_id, event_id, event_map, state_res_store
+        pl = _get_power_level_for_sender(
+            room_id, event_id, event_map, power_levels_cache, auth_event_ids_cache
         )
         event_to_pl[event_id] = pl
 
@@ -365,22 +440,28 @@ def _reverse_topological_power_sort(
         if idx % _YIELD_AFTER_ITERATIONS == 0:
             yield clock.sleep(0)
 
-    def _get_power_order(event_id):
-        ev = event_map[event_id]
-        pl = event_to_pl[event_id]
-
-        return -pl, ev.origin_server_ts, event_id
+    power_order = {
+        event_id: (-pl, event_map[event_id].origin_server_ts, event_id)
+        for event_id, pl in event_to_pl.items()
+    }
 
-    # Note: graph is modified during the sort
-    it = lexicographical_topological_sort(graph, key=_get_power_order)
-    sorted_events = list(it)
+    sorted_events = _lexicographical_topological_sort_list(
+        graph, key=power_order.__getitem__
+    )
 
     return sorted_events
 
 
 @defer.inlineCallbacks
 def _iterative_auth_checks(
-    clock, room_id, room_version, event_ids, base_state, event_map, state_res_store
+    clock,
+    room_id,
+    room_version,
+    event_ids,
+    base_state,
+    event_map,
+    state_res_store,
+    auth_event_ids_cache,
 ):
     """Sequentially apply auth checks to each event in given list, updating the
     state as it goes along.
@@ -393,22 +474,58 @@ def _iterative_auth_checks(
         base_state (StateMap[str]): The set of state to start with
         event_map (dict[str,FrozenEvent])
         state_res_store (StateResolutionStore)
+        auth_event_ids_cache (dict[str, tuple[str]]): A cache of event ID to
+            auth event IDs, as used by `_get_auth_event_ids`.
 
     Returns:
-        Deferred[StateMap[str]]: Returns the final updated state
+        Deferred[StateMap[str]]: Returns the final updated state. If there are
+        no events to check this is `base_state` itself, rather than a copy.
     """
+    if not event_ids:
+        return base_state
+
     resolved_state = base_state.copy()
     room_version_obj = KNOWN_ROOM_VERSIONS[room_version]
 
+    # Fetch all the auth events we're going to need up front, rather than one
+    # at a time as we check each event.
+    yield _prefetch_events(
+        set(
+            itertools.chain.from_iterable(
+                _get_auth_event_ids(event_map[event_id], auth_event_ids_cache)
+                for event_id in event_ids
+            )
+        ),
+        event_map,
+        state_res_store,
+    )
+
     for idx, event_id in enumerate(event_ids, start=1):
         event = event_map[event_id]
 
-        auth_events = {}
-        for aid in event.auth_event_ids():
-            ev = yield _get_event(
-                room_id, aid, event_map, state_res_store, allow_none=True
+        # Similarly, at the start of each batch of events we fetch the events
+        # from the resolved state that they will reference.
+        if idx % _YIELD_AFTER_ITERATIONS == 1:
+            batch = event_ids[idx - 1 : idx - 1 + _YIELD_AFTER_ITERATIONS]
+            yield _prefetch_events(
+                {
+                    resolved_state[key]
+                    for batch_event_id in batch
+                    for key in event_auth.auth_types_for_event(
+                        event_map[batch_event_id]
+                    )
+                    if key in resolved_state
+                },
+                event_map,
+                state_res_store,
             )
 
+        # The auth events have all been prefetched above, so we can look them
+        # up directly.
+        auth_events = {}
+        for aid in _get_auth_event_ids(event, auth_event_ids_cache):
+            ev = _get_prefetched_event(room_id, aid, event_map)
+
             if not ev:
                 logger.warning(
                     "auth_event id %s for event %s is missing", aid, event_id
@@ -420,10 +537,15 @@ def _iterative_auth_checks(
         for key in event_auth.auth_types_for_event(event):
             if key in resolved_state:
                 ev_id = resolved_state[key]
-                ev = yield _get_event(room_id, ev_id, event_map, state_res_store)
+
+                # We will usually have already fetched the event above, so
+                # check the event map before falling back to `_get_event`.
+                ev = event_map.get(ev_id)
+                if ev is None:
+                    ev = yield _get_event(room_id, ev_id, event_map, state_res_store)
 
                 if ev.rejected_reason is None:
-                    auth_events[key] = event_map[ev_id]
+                    auth_events[key] = ev
 
         try:
             event_auth.check(
@@ -448,7 +570,13 @@ def _iterative_auth_checks(
 
 @defer.inlineCallbacks
 def _mainline_sort(
-    clock, room_id, event_ids, resolved_power_event_id, event_map, state_res_store
+    clock,
+    room_id,
+    event_ids,
+    resolved_power_event_id,
+    event_map,
+    state_res_store,
+    auth_event_ids_cache,
 ):
     """Returns a sorted list of event_ids sorted by mainline ordering based on
     the given event resolved_power_event_id
@@ -460,6 +588,8 @@ def _mainline_sort(
         resolved_power_event_id (str): The final resolved power level event ID
         event_map (dict[str,FrozenEvent])
         state_res_store (StateResolutionStore)
+        auth_event_ids_cache (dict[str, tuple[str]]): A cache of event ID to
+            auth event IDs, as used by `_get_auth_event_ids`.
 
     Returns:
         Deferred[list[str]]: The sorted list
@@ -475,15 +605,12 @@ def _mainline_sort(
     while pl:
         mainline.append(pl)
         pl_ev = yield _get_event(room_id, pl, event_map, state_res_store)
-        auth_events = pl_ev.auth_event_ids()
-        pl = None
-        for aid in auth_events:
-            ev = yield _get_event(
-                room_id, aid, event_map, state_res_store, allow_none=True
-            )
-            if ev and (ev.type, ev.state_key) == (EventTypes.PowerLevels, ""):
-                pl = aid
-                break
+        yield _prefetch_events(
+            _get_auth_event_ids(pl_ev, auth_event_ids_cache), event_map, state_res_store
+        )
+        pl = _get_power_level_auth_event_id(
+            room_id, pl_ev, event_map, auth_event_ids_cache
+        )
 
         # We yield occasionally when we're working with large data sets to
         # ensure that we don't block the reactor loop for too long.
@@ -496,17 +623,20 @@ def _mainline_sort(
 
     event_ids = list(event_ids)
 
-    order_map = {}
-    for idx, ev_id in enumerate(event_ids, start=1):
-        depth = yield _get_mainline_depth_for_event(
-            event_map[ev_id], mainline_map, event_map, state_res_store
-        )
-        order_map[ev_id] = (depth, event_map[ev_id].origin_server_ts, ev_id)
+    depths = yield _get_mainline_depths_for_events(
+        clock,
+        room_id,
+        event_ids,
+        mainline_map,
+        event_map,
+        state_res_store,
+        auth_event_ids_cache,
+    )
 
-        # We yield occasionally when we're working with large data sets to
-        # ensure that we don't block the reactor loop for too long.
-        if idx % _YIELD_AFTER_ITERATIONS == 0:
-            yield clock.sleep(0)
+    order_map = {
+        ev_id: (depths[ev_id], event_map[ev_id].origin_server_ts, ev_id)
+        for ev_id in event_ids
+    }
 
     event_ids.sort(key=lambda ev_id: order_map[ev_id])
 
@@ -514,42 +644,165 @@ def _mainline_sort(
 
 
 @defer.inlineCallbacks
-def _get_mainline_depth_for_event(event, mainline_map, event_map, state_res_store):
-    """Get the mainline depths for the given event based on the mainline map
+def _get_mainline_depths_for_events(
+    clock,
+    room_id,
+    event_ids,
+    mainline_map,
+    event_map,
+    state_res_store,
+    auth_event_ids_cache,
+):
+    """Get the mainline depths for the given events based on the mainline map
 
     Args:
-        event (FrozenEvent)
+        clock (Clock)
+        room_id (str): room we're working in
+        event_ids (list[str]): Events to get the depths for
         mainline_map (dict[str, int]): Map from event_id to mainline depth for
             events in the mainline.
         event_map (dict[str,FrozenEvent])
         state_res_store (StateResolutionStore)
+        auth_event_ids_cache (dict[str, tuple[str]]): A cache of event ID to
+            auth event IDs, as used by `_get_auth_event_ids`.
 
     Returns:
-        Deferred[int]
+        Deferred[dict[str, int]]: Map from event_id to mainline depth
     """
 
-    room_id = event.room_id
+    # First we find the power level auth event (if any) of each event we need,
+    # walking up from the given events until we reach the mainline. Many of
+    # the events will share power level events, so we only look at each event
+    # once. This is done a step at a time so that we can fetch the auth events
+    # needed by all the events in a step in one go.
+    #
+    # Map from event_id to the event_id of the power level event in its auth
+    # events, or None if it has none.
+    pl_auth_event_ids = {}  # type: Dict[str, Optional[str]]
 
-    # We do an iterative search, replacing `event with the power level in its
-    # auth events (if any)
-    while event:
-        depth = mainline_map.get(event.event_id)
-        if depth is not None:
-            return depth
+    frontier = {event_id for event_id in event_ids if event_id not in mainline_map}
 
-        auth_events = event.auth_event_ids()
-        event = None
+    idx = 0
+    while frontier:
+        yield _prefetch_events(
+            {
+                aid
+                for event_id in frontier
+                for aid in _get_auth_event_ids(
+                    event_map[event_id], auth_event_ids_cache
+                )
+            },
+            event_map,
+            state_res_store,
+        )
 
-        for aid in auth_events:
-            aev = yield _get_event(
-                room_id, aid, event_map, state_res_store, allow_none=True
+        next_frontier = set()
+        for event_id in frontier:
+            pl = _get_power_level_auth_event_id(
+                room_id, event_map[event_id], event_map, auth_event_ids_cache
             )
-            if aev and (aev.type, aev.state_key) == (EventTypes.PowerLevels, ""):
-                event = aev
-                break
+            pl_auth_event_ids[event_id] = pl
+
+            if pl is not None and pl not in mainline_map:
+                next_frontier.add(pl)
+
+            # We yield occasionally when we're working with large data sets to
+            # ensure that we don't block the reactor loop for too long.
+            idx += 1
+            if idx % _YIELD_AFTER_ITERATIONS == 0:
+                yield clock.sleep(0)
+
+        next_frontier.difference_update(pl_auth_event_ids)
+        frontier = next_frontier
+
+    # Now we follow the power level events from each event until we reach the
+    # mainline, recording the depth of every event we pass through so that
+    # later searches can stop as soon as they reach one of them. Events that
+    # don't lead to the mainline have a depth of 0.
+    depth_cache = dict(mainline_map)
+
+    depths = {}
+    for event_id in event_ids:
+        path = []
+        reached_id = event_id
+        while reached_id is not None and reached_id not in depth_cache:
+            path.append(reached_id)
+            reached_id = pl_auth_event_ids[reached_id]
+
+        depth = 0 if reached_id is None else depth_cache[reached_id]
+        for path_event_id in path:
+            depth_cache[path_event_id] = depth
+
+        depths[event_id] = depth
+
+    return depths
+
+
+def _get_power_level_auth_event_id(room_id, event, event_map, auth_event_ids_cache):
+    """Helper function to find the power levels event in the auth events of
+    the given event.
+
+    The auth events should already have been fetched into event_map, e.g. via
+    `_prefetch_events`. Any that are missing are ignored.
+
+    Args:
+        room_id (str)
+        event (FrozenEvent)
+        event_map (dict[str,FrozenEvent])
+        auth_event_ids_cache (dict[str, tuple[str]]): A cache of event ID to
+            auth event IDs, as used by `_get_auth_event_ids`.
+
+    Returns:
+        Optional[str]: The event ID of the power levels event, if any
+    """
+    for aid in _get_auth_event_ids(event, auth_event_ids_cache):
+        aev = _get_prefetched_event(room_id, aid, event_map)
+        if aev and (aev.type, aev.state_key) == (EventTypes.PowerLevels, ""):
+            return aid
+
+    return None
 
-    # Didn't find a power level auth event, so we just return 0
-    return 0
+
+def _get_auth_event_ids(event, auth_event_ids_cache):
+    """Helper function to get the auth event IDs of the given event, caching
+    the result.
+
+    Args:
+        event (FrozenEvent)
+        auth_event_ids_cache (dict[str, tuple[str]]): A cache of event ID to
+            auth event IDs. This is updated with the result.
+
+    Returns:
+        tuple[str]
+    """
+    auth_event_ids = auth_event_ids_cache.get(event.event_id)
+    if auth_event_ids is None:
+        auth_event_ids = tuple(event.auth_event_ids())
+        auth_event_ids_cache[event.event_id] = auth_event_ids
+    return auth_event_ids
+
+
+@defer.inlineCallbacks
+def _prefetch_events(event_ids, event_map, state_res_store):
+    """Helper function to fetch any of the given events that are not already
+    in event_map in a single batch, adding them to event_map.
+
+    Events that can't be found are left out of event_map; callers should look
+    up the events they need with `_get_prefetched_event`, which returns None
+    for them.
+
+    Args:
+        event_ids (Iterable[str])
+        event_map (dict[str,FrozenEvent])
+        state_res_store (StateResolutionStore)
+
+    Returns:
+        Deferred
+    """
+    missing = [event_id for event_id in event_ids if event_id not in event_map]
+    if missing:
+        events = yield state_res_store.get_events(missing, allow_rejected=True)
+        event_map.update(events)
 
 
 @defer.inlineCallbacks
@@ -571,14 +824,31 @@ def _get_event(room_id, event_id, event_map, state_res_store, allow_none=False):
     if event_id not in event_map:
         events = yield state_res_store.get_events([event_id], allow_rejected=True)
         event_map.update(events)
-    event = event_map.get(event_id)
+    event = _get_prefetched_event(room_id, event_id, event_map)
 
     if event is None:
         if allow_none:
             return None
         raise Exception("Unknown event %s" % (event_id,))
 
-    if event.room_id != room_id:
+    return event
+
+
+def _get_prefetched_event(room_id, event_id, event_map):
+    """Helper function to look up an event that has already been fetched into
+    event_map, without going to the store.
+
+    Args:
+        room_id (str)
+        event_id (str)
+        event_map (dict[str,FrozenEvent])
+
+    Returns:
+        Optional[FrozenEvent]: None if the event is not in event_map
+    """
+    event = event_map.get(event_id)
+
+    if event is not None and event.room_id != room_id:
         raise Exception(
             "In state res for room %s, event %s is in %s"
             % (room_id, event_id, event.room_id)
@@ -593,8 +863,6 @@ def lexicographical_topological_sort(graph, key):
     appears before A in the sort), with ties broken lexicographically based on
     return value of the `key` function.
 
-    NOTE: `graph` is modified during the sort.
-
     Args:
         graph (dict[str, set[str]]): A representation of the graph where each
             node is a key in the dict and its value are the nodes edges.
@@ -604,35 +872,60 @@ def lexicographical_topological_sort(graph, key):
     Yields:
         str: The next node in the topological sort
     """
+    yield from _lexicographical_topological_sort_list(graph, key)
+
+
+def _lexicographical_topological_sort_list(graph, key):
+    """Performs a lexicographic reverse topological sort on the graph, as per
+    `lexicographical_topological_sort`, returning the result as a list.
+
+    Args:
+        graph (dict[str, set[str]]): A representation of the graph where each
+            node is a key in the dict and its value are the nodes edges.
+        key (func): A function that takes a node and returns a value that is
+            comparable and used to order nodes
+
+    Returns:
+        list[str]: The nodes in topological order
+    """
 
     # Note, this is basically Kahn's algorithm except we look at nodes with no
     # outgoing edges, c.f.
     # https://en.wikipedia.org/wiki/Topological_sorting#Kahn's_algorithm
-    outdegree_map = graph
-    reverse_graph = {}
+    outdegree_map = {}
+
+    # Each edge only appears once, so we can use lists for the reverse graph
+    # rather than sets.
+    reverse_graph = {node: [] for node in graph}  # type: Dict[str, List[str]]
+
+    # We only calculate the key for each node once, as the key function may
+    # be expensive.
+    node_keys = {node: key(node) for node in graph}
 
     # Lists of nodes with zero out degree. Is actually a tuple of
     # `(key(node), node)` so that sorting does the right thing
     zero_outdegree = []
 
     for node, edges in graph.items():
+        outdegree_map[node] = len(edges)
         if len(edges) == 0:
-            zero_outdegree.append((key(node), node))
+            zero_outdegree.append((node_keys[node], node))
 
-        reverse_graph.setdefault(node, set())
         for edge in edges:
-            reverse_graph.setdefault(edge, set()).add(node)
+            reverse_graph.setdefault(edge, []).append(node)
 
     # heapq is a built in implementation of a sorted queue.
     heapq.heapify(zero_outdegree)
 
+    sorted_nodes = []
     while zero_outdegree:
         _, node = heapq.heappop(zero_outdegree)
 
         for parent in reverse_graph[node]:
-            out = outdegree_map[parent]
-            out.discard(node)
-            if len(out) == 0:
-                heapq.heappush(zero_outdegree, (key(parent), parent))
+            outdegree_map[parent] -= 1
+            if outdegree_map[parent] == 0:
+                heapq.heappush(zero_outdegree, (node_keys[parent], parent))
+
+        sorted_nodes.append(node)
 
-        yield node
+    return sorted_nodes
@@ -15,6 +15,8 @@
 
 import itertools
 
+from mock import patch
+
 import attr
 
 from twisted.internet import defer
@@ -23,7 +25,13 @@ from synapse.api.constants import EventTypes, JoinRules, Membership
 from synapse.api.room_versions import RoomVersions
 from synapse.event_auth import auth_types_for_event
 from synapse.events import make_event_from_dict
-from synapse.state.v2 import lexicographical_topological_sort, resolve_events_with_store
+from synapse.state import v2
+from synapse.state.v2 import (
+    _get_mainline_depths_for_events,
+    _seperate,
+    lexicographical_topological_sort,
+    resolve_events_with_store,
+)
 from synapse.types import EventID
 
 from tests import unittest
@@ -409,10 +417,7 @@ class StateTestCase(unittest.TestCase):
         # node_id -> state
         state_at_event = {}
 
-        # We copy the map as the sort consumes the graph
-        graph_copy = {k: set(v) for k, v in graph.items()}
-
-        for node_id in lexicographical_topological_sort(graph_copy, key=lambda e: e):
+        for node_id in lexicographical_topological_sort(graph, key=lambda e: e):
             fake_event = fake_event_map[node_id]
             event_id = fake_event.event_id
 
@@ -479,6 +484,232 @@ class LexicographicalTestCase(unittest.TestCase):
 
         self.assertEqual(["o", "l", "n", "m", "p"], res)
 
+        # The graph should not have been modified by the sort.
+        self.assertEqual(
+            {"l": {"o"}, "m": {"n", "o"}, "n": {"o"}, "o": set(), "p": {"o"}}, graph
+        )
+
+
+class SeperateTestCase(unittest.TestCase):
+    def test_seperate(self):
+        state_sets = [
+            {("a", ""): "A1", ("b", ""): "B1", ("c", ""): "C1", ("d", ""): "D1"},
+            {("a", ""): "A1", ("b", ""): "B2", ("c", ""): "C1"},
+            {("a", ""): "A1", ("b", ""): "B3", ("c", ""): "C2"},
+        ]
+
+        unconflicted, conflicted = _seperate(state_sets)
+
+        self.assertEqual({("a", ""): "A1"}, unconflicted)
+        self.assertEqual(
+            {
+                ("b", ""): {"B1", "B2", "B3"},
+                ("c", ""): {"C1", "C2"},
+                ("d", ""): {"D1"},
+            },
+            conflicted,
+        )
+
+    def test_seperate_interns_conflicts(self):
+        state_sets = [
+            {("a", ""): "X", ("b", ""): "X"},
+            {("a", ""): "Y", ("b", ""): "Y"},
+        ]
+
+        _, conflicted = _seperate(state_sets)
+
+        self.assertEqual({"X", "Y"}, conflicted[("a", "")])
+        self.assertIs(conflicted[("a", "")], conflicted[("b", "")])
+
+
+class MainlineDepthsTestCase(unittest.TestCase):
+    def test_shared_power_level_chain(self):
+        # Build a chain of power level events hanging off the mainline, with
+        # many events authed by the end of the chain.
+        mainline = FakeEvent(
+            id="PA", sender=ALICE, type=EventTypes.PowerLevels, state_key="", content={}
+        )
+        pl1 = FakeEvent(
+            id="PB", sender=ALICE, type=EventTypes.PowerLevels, state_key="", content={}
+        )
+        pl2 = FakeEvent(
+            id="PC", sender=ALICE, type=EventTypes.PowerLevels, state_key="", content={}
+        )
+        orphan = FakeEvent(
+            id="O", sender=ALICE, type=EventTypes.Topic, state_key="", content={}
+        )
+
+        event_map = {
+            mainline.event_id: mainline.to_event([], []),
+            pl1.event_id: pl1.to_event([mainline.event_id], []),
+            pl2.event_id: pl2.to_event([pl1.event_id], []),
+            orphan.event_id: orphan.to_event([], []),
+        }
+
+        event_ids = [orphan.event_id]
+        for i in range(50):
+            topic = FakeEvent(
+                id="T%d" % (i,),
+                sender=ALICE,
+                type=EventTypes.Topic,
+                state_key="",
+                content={},
+            )
+            event_map[topic.event_id] = topic.to_event([pl2.event_id], [])
+            event_ids.append(topic.event_id)
+
+        with patch.object(
+            v2,
+            "_get_power_level_auth_event_id",
+            wraps=v2._get_power_level_auth_event_id,
+        ) as get_pl_auth_event_id:
+            depths_d = _get_mainline_depths_for_events(
+                FakeClock(),
+                ROOM_ID,
+                event_ids,
+                {mainline.event_id: 1},
+                event_map,
+                TestStateResolutionStore(event_map),
+                {},
+            )
+
+            depths = self.successResultOf(depths_d)
+
+        expected = {event_id: 1 for event_id in event_ids}
+        expected[orphan.event_id] = 0
+        self.assertEqual(expected, depths)
+
+        # Each event off the mainline should only have been looked at once.
+        self.assertEqual(len(event_ids) + 2, get_pl_auth_event_id.call_count)
+
+
+class GetEventsBatchingTestCase(unittest.TestCase):
+    def test_get_events_calls(self):
+        # Check that a resolution starting with an empty event map fetches the
+        # events it needs in batches, rather than one at a time.
+        event_map = {}
+
+        # node_id -> event_id
+        event_ids = {}
+
+        def add_event(id, sender, type, state_key, content, auth_events):
+            fake_event = FakeEvent(id, sender, type, state_key, content)
+            event_map[fake_event.event_id] = fake_event.to_event(
+                [event_ids[a] for a in auth_events], []
+            )
+            event_ids[id] = fake_event.event_id
+
+        pl_content = {"users": {ALICE: 100, BOB: 50}}
+
+        add_event("CREATE", ALICE, EventTypes.Create, "", {"creator": ALICE}, [])
+        add_event(
+            "IMA", ALICE, EventTypes.Member, ALICE, MEMBERSHIP_CONTENT_JOIN, ["CREATE"]
+        )
+
+        # The mainline of the resolved power levels is P2 -> P1 -> P0.
+        add_event(
+            "P0", ALICE, EventTypes.PowerLevels, "", pl_content, ["CREATE", "IMA"]
+        )
+        add_event(
+            "P1", ALICE, EventTypes.PowerLevels, "", pl_content, ["CREATE", "IMA", "P0"]
+        )
+        add_event(
+            "P2", ALICE, EventTypes.PowerLevels, "", pl_content, ["CREATE", "IMA", "P1"]
+        )
+        add_event(
+            "IMB",
+            BOB,
+            EventTypes.Member,
+            BOB,
+            MEMBERSHIP_CONTENT_JOIN,
+            ["CREATE", "P0"],
+        )
+
+        # Old power levels that aren't on the mainline, PW -> PX.
+        add_event(
+            "PW", ALICE, EventTypes.PowerLevels, "", pl_content, ["CREATE", "IMA", "P0"]
+        )
+        add_event(
+            "PX", ALICE, EventTypes.PowerLevels, "", pl_content, ["CREATE", "IMA", "PW"]
+        )
+
+        # Alice and Bob both update their membership, so the resolved state
+        # refers to newer membership events than the power events' auth events.
+        add_event(
+            "IMA2",
+            ALICE,
+            EventTypes.Member,
+            ALICE,
+            MEMBERSHIP_CONTENT_JOIN,
+            ["CREATE", "IMA", "P2"],
+        )
+        add_event(
+            "IMB2",
+            BOB,
+            EventTypes.Member,
+            BOB,
+            MEMBERSHIP_CONTENT_JOIN,
+            ["CREATE", "IMB", "PX"],
+        )
+
+        # The conflicted power levels and topics.
+        add_event(
+            "PA", ALICE, EventTypes.PowerLevels, "", pl_content, ["CREATE", "IMA", "P2"]
+        )
+        add_event(
+            "PB", BOB, EventTypes.PowerLevels, "", pl_content, ["CREATE", "IMB", "P2"]
+        )
+        add_event("T1", ALICE, EventTypes.Topic, "", {}, ["CREATE", "IMA2", "PX"])
+        add_event("T2", BOB, EventTypes.Topic, "", {}, ["CREATE", "IMB2", "PB"])
+
+        def state_set(*node_ids):
+            return {
+                (event_map[event_id].type, event_map[event_id].state_key): event_id
+                for event_id in (event_ids[n] for n in node_ids)
+            }
+
+        state_sets = [
+            state_set("CREATE", "IMA2", "IMB2", "PA", "T1"),
+            state_set("CREATE", "IMA2", "IMB2", "PB", "T2"),
+        ]
+
+        store = TestStateResolutionStore(event_map)
+        with patch.object(store, "get_events", wraps=store.get_events) as get_events:
+            state_d = resolve_events_with_store(
+                FakeClock(),
+                ROOM_ID,
+                RoomVersions.V2.identifier,
+                state_sets,
+                event_map=None,
+                state_res_store=store,
+            )
+            self.successResultOf(state_d)
+
+        # The node IDs of the events fetched by each call to `get_events`.
+        batches = [
+            {node_id for node_id, event_id in event_ids.items() if event_id in args[0]}
+            for args, _ in get_events.call_args_list
+        ]
+
+        self.assertEqual(
+            [
+                # The full conflicted set.
+                {"PA", "PB", "T1", "T2"},
+                # The auth events of the power events, for sorting them.
+                {"CREATE", "IMA", "IMB", "P2"},
+                # The iterative auth checks of the power events fetch the
+                # events they need from the resolved state in one go.
+                {"IMA2", "IMB2"},
+                # The walk down the mainline, one call per step.
+                {"P1"},
+                {"P0"},
+                # The walk from the topics to the mainline, one call per step.
+                {"PX"},
+                {"PW"},
+            ],
+            batches,
+        )
+
 
 class SimpleParamStateTestCase(unittest.TestCase):
     def setUp(self):